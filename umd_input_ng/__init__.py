@@ -7,15 +7,18 @@ __copyright__ = "2021, glatavento <glatavento@outlook.com>"
 __version__ = (0, 1, 1)
 
 import logging
+import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import IO
+from typing import IO, Optional
 
 from calibre.customize.conversion import InputFormatPlugin
 from calibre.ebooks.txt.processor import convert_basic
 from calibre.ptempfile import TemporaryDirectory
 
-from .umd_io import UMDFile
+from .umd_io import Chapter, UMDFile
 
 umd_plugin_logger = logging.Logger("umd-input-plugin", logging.INFO)
 stdout_handler = logging.StreamHandler()
@@ -23,6 +26,23 @@ stdout_handler.setFormatter(logging.Formatter("%(asctime)s - %(filename)s: %(lin
                                               datefmt="%Y-%m-%d %H:%M:%S %p"))
 umd_plugin_logger.addHandler(stdout_handler)
 
+# characters stripped from every chapter before conversion (U+2029 PARAGRAPH SEPARATOR)
+_PARA_SEP_TRANS = str.maketrans("", "", "\u2029")
+
+
+def _write_chapter(tmp_dir: Path, i: int, ch: Chapter) -> Optional[Path]:
+    # runs on a worker thread: only touches the chapter and its own file, never the oeb book
+    if ch.title is None or ch.raw_content is None:
+        return None
+    ch_title, ch_content = ch.title, ch.content.translate(_PARA_SEP_TRANS)
+    if not ch_content.strip():
+        # nothing but whitespace / paragraph separators, don't emit an empty page
+        return None
+    ch_fn = tmp_dir / f"ch_{i:04d}.html"
+    # convert_basic declares utf-8, encode once and hand it over in a single write
+    ch_fn.write_bytes(convert_basic(ch_content, title=ch_title).encode("utf-8"))
+    return ch_fn
+
 
 # noinspection PyAbstractClass
 class UMDInput(InputFormatPlugin):
@@ -58,14 +78,14 @@ class UMDInput(InputFormatPlugin):
             oeb.container = DirContainer(tmp_dir, log)
             content, cover = book.chapters, book.cover
             if content:
-                for i, ch in enumerate(content):
-                    ch_title, ch_content = ch.title, ch.content
-                    if ch_title is None or ch_content is None:
+                # convert and write the chapters in parallel, but register them with the book
+                # here on the calling thread and in their original order
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                    ch_fns = list(executor.map(partial(_write_chapter, Path(tmp_dir)), range(len(content)), content))
+                for ch, ch_fn in zip(content, ch_fns):
+                    if ch_fn is None:
                         continue
-                    ch_content = ch_content.replace("\u2029", "")
-                    ch_fn = Path(tmp_dir) / f"ch_{i:04d}.html"
-                    ch_fn.write_text(convert_basic(ch_content, title=ch_title))
-                    oeb.toc.add(ch_title, ch_fn.name)
+                    oeb.toc.add(ch.title, ch_fn.name)
                     id_, href = oeb.manifest.generate(id='html', href=ch_fn.name)
                     item = oeb.manifest.add(id_, href, 'text/html')
                     item.html_input_href = ch_fn.name
@@ -74,5 +94,6 @@ class UMDInput(InputFormatPlugin):
                 cover_file = Path(tmp_dir) / "cover.jpeg"
                 cover_file.write_bytes(cover)
                 id_, href = oeb.manifest.generate(id='image', href=cover_file.name)
+                oeb.manifest.add(id_, href, 'image/jpeg')
                 oeb.guide.add('cover', 'Cover', href)
         return oeb
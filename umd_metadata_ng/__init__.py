@@ -33,7 +33,8 @@ class UmdMetaReader(MetadataReaderPlugin):
     @staticmethod
     def get_metadata(stream: IO, f_type: str) -> Metadata:
         assert f_type == "umd"
-        book = UMDFile.from_stream(stream)
+        # metadata only, don't inflate the whole body
+        book = UMDFile.from_stream(stream, read_chapters=False)
         metadata = Metadata(title=book.title,
                             authors=[book.author])
         metadata.publisher = book.publisher
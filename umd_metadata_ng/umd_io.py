@@ -2,15 +2,19 @@
 # Date: 2021/4/30 下午7:52
 # Author: glatavento
 
+import array
 import datetime
 import logging
+import mmap
 import struct
+import sys
+import traceback
 import zlib
-from collections import namedtuple
+from codecs import utf_16_le_decode
 from pathlib import Path
-from typing import Literal, IO, Dict, List, Tuple
+from typing import Literal, IO, Dict, List, Optional, Tuple, Union
 
-__all__ = ['UMDFile']
+__all__ = ['Chapter', 'UMDFile']
 
 umd_io_logger = logging.Logger("umd-io", logging.INFO)
 stdout_handler = logging.StreamHandler()
@@ -37,167 +41,295 @@ _BLOCK_TYPE_DICT = {
     0x0c: "end_of_file"
 }
 
-Chapter = namedtuple("Chapter", "title content")
+# precompiled struct formats, shared by all readers below
+_S_SPLIT_TYPE = struct.Struct("<cH")
+_S_CAT = struct.Struct("<hbh")
+_S_META_STR = struct.Struct("<bb")
+_S_FULLLEN = struct.Struct("<hi")
+_S_BLOCK15 = struct.Struct("<hibii")
+_S_CHTLEN = struct.Struct("<b")
+_S_END_A = struct.Struct("<h")
+_S_END_I = struct.Struct("<hi")
+_S_DOLLAR = struct.Struct("<ii")
+_S_COVER = struct.Struct("<bbbibii")
+
+# deflate can't expand data by more than ~1032:1, a larger full_length can't be right
+_MAX_INFLATE_RATIO = 1032
+
+# anything supporting the buffer protocol, usually a memoryview over the whole file
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class Chapter:
+    # raw_content is the chapter's utf-16-le slice of the body, decoded on first access to `content`
+    __slots__ = ("title", "raw_content", "_content")
+
+    def __init__(self, title: str, raw_content: Buffer):
+        self.title = title
+        self.raw_content = raw_content
+        self._content: Optional[str] = None
+
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            self._content = utf_16_le_decode(self.raw_content)[0]
+        return self._content
+
+    def __eq__(self, other):
+        if not isinstance(other, Chapter):
+            return NotImplemented
+        return self.title == other.title and self.raw_content == other.raw_content
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Chapter(title={self.title!r})"
+
+
+def _unpack_int32_array(buf: Buffer, offset: int, count: int) -> array.array:
+    # bulk load `count` little-endian int32 starting at `offset`
+    int32_array = array.array("i")
+    int32_array.frombytes(buf[offset:offset + 4 * count])
+    if sys.byteorder != "little":
+        int32_array.byteswap()
+    return int32_array
+
+
+# metadata block handlers: (buf, off, block_type, metadata) -> offset after the block
+def _parse_category(buf: Buffer, off: int, block_type: str, metadata: Dict) -> int:
+    #              #    01 [   h1 cb    h2]  #    02
+    # 89 9B 9A DE 23 01 00 [00 08 01 B1 0C] 23 02 00 00 27 BB...
+    # cb: category_byte
+    h1, category_byte, h2 = _S_CAT.unpack_from(buf, off)
+    # only support novel!
+    metadata["category"] = {0x01: "Novel", "0x02": "Comic"}[category_byte]
+    umd_io_logger.debug("hi, h2: %s, %s", h1, h2)
+    return off + 5
+
+
+def _parse_string(buf: Buffer, off: int, block_type: str, metadata: Dict) -> int:
+    #              # 00 01                 #    02 [b1 le chapters...
+    # 89 9B 9A DE 23 01 00 00 08 01 B1 0C 23 02 00 [00 27 BB 90 A7...
+    # le: raw_length, length = raw_length - 5
+    b1, raw_length = _S_META_STR.unpack_from(buf, off)
+    off += 2
+    metadata[block_type] = utf_16_le_decode(buf[off:off + raw_length - 5])[0]
+    umd_io_logger.debug("b1: %s", b1)
+    return off + raw_length - 5
+
+
+def _parse_full_length(buf: Buffer, off: int, block_type: str, metadata: Dict) -> int:
+    #  #    0b [   h1 full_length]  # 83
+    # 23 0b 00 [00 09 52 08 03 00] 23 83...
+    h1, full_length = _S_FULLLEN.unpack_from(buf, off)
+    metadata["full_length"] = full_length
+    umd_io_logger.debug("h1: %s", h1)
+    return off + 6
+
+
+def _parse_chapter_offsets(buf: Buffer, off: int, block_type: str, metadata: Dict) -> int:
+    #  #    83 [   h1          r1 b1          r2       ch_no ch01_offset ch02_offset ...
+    # 23 83 00 [01 09 B0 39 00 00 24 B0 39 00 00 3D 00 00 00 00 00 00 00 36 03 ...
+    # ch_no: raw_number_of_chapters, number_of_chapters = (raw_ch_no - 9) / 4
+    h1, i1, b1, i2, raw_ch_no = _S_BLOCK15.unpack_from(buf, off)
+    off += 15
+    assert i1 == i2
+    number_of_chapters = (raw_ch_no - 9) >> 2
+    chapter_offsets = _unpack_int32_array(buf, off, number_of_chapters)
+    metadata["chapter_offsets"] = tuple(x >> 1 for x in chapter_offsets)
+    umd_io_logger.debug("h1, i1, b1, i2: %s, %s, %s, %s", h1, i1, b1, i2)
+    return off + 4 * number_of_chapters
+
+
+def _parse_chapter_titles(buf: Buffer, off: int, block_type: str, metadata: Dict) -> int:
+    #  #    84 [   h1          i1 b1          i2 [ raw_tt_len l1 title1 ...
+    # 23 84 00 [01 09 02 4C 00 00 24 02 4C 00 00 [B0 01 00 00 10 2C 7B 00 4E 77 53 20 00 BA 4E ...
+    # raw_tt_len: raw_length_of_titles, title_length = raw_tt_len - 9
+    h1, i1, b1, i2, title_len = _S_BLOCK15.unpack_from(buf, off)
+    off += 15
+    assert i1 == i2
+    end = off + title_len - 9
+    content = []
+    while off < end:
+        ch_title_len = _S_CHTLEN.unpack_from(buf, off)[0]
+        off += 1
+        # title_bytes |> decode |> append to chapters list
+        content.append(utf_16_le_decode(buf[off:off + ch_title_len])[0])
+        off += ch_title_len
+    metadata["chapter_titles"] = content
+    umd_io_logger.debug("h1, i1, b1, i2: %s, %s, %s, %s", h1, i1, b1, i2)
+    return off
+
+
+_METADATA_HANDLERS = {
+    0x01: _parse_category,
+    **{bt: _parse_string for bt in range(0x02, 0x0a)},
+    0x0b: _parse_full_length,
+    0x83: _parse_chapter_offsets,
+    0x84: _parse_chapter_titles,
+}
+
+
+def _scan_body(buf: Buffer, off: int) -> Tuple[List[Buffer], List[int], int]:
+    # walk the body up to the #81 end-of-body block without decompressing anything
+    # returns the raw zlib blocks, their random ids and the offset right after the #81 type
+    raw_blocks = []
+    rnd_lst = []
+    size = len(buf)
+    while off < size:
+        splitter = buf[off]
+        off += 1
+        if splitter == 0x23:  # '#'
+            end_type = _S_END_A.unpack_from(buf, off)[0]
+            off += 2
+            umd_io_logger.debug("end_type: %s", end_type)
+            if end_type == 0x81:
+                return raw_blocks, rnd_lst, off
+            elif end_type == 0xf1:
+                # h + 16 bytes, only interesting for debugging
+                if umd_io_logger.isEnabledFor(logging.DEBUG):
+                    umd_io_logger.debug("h, s: %s, %s", _S_END_A.unpack_from(buf, off)[0], bytes(buf[off + 2:off + 18]))
+                off += 18
+            elif end_type == 0x0a:
+                # h + i, only interesting for debugging
+                if umd_io_logger.isEnabledFor(logging.DEBUG):
+                    umd_io_logger.debug("h, i: %s", _S_END_I.unpack_from(buf, off)[1])
+                off += 6
+        elif splitter == 0x24:  # '$'
+            #  $           i raw_blc_len block...
+            # 24 91 F1 E1 F4 6D 45 00 00 78 9C 8D BD ...
+            # raw_blc_len: raw_block_length, block_length = raw_block_length - 9
+            i, raw_block_length = _S_DOLLAR.unpack_from(buf, off)
+            off += 8
+            umd_io_logger.debug("i: %s", i)
+            rnd_lst.append(i)
+            # block |> append to raw_blocks, decompressed by the caller
+            raw_blocks.append(buf[off:off + raw_block_length - 9])
+            off += raw_block_length - 9
+        else:
+            raise ValueError(f"Unexpected splitter {splitter:#04x} at {off - 1}.")
+    raise ValueError("Unexpected end of file in body.")
+
+
+def _parse_end_of_body(buf: Buffer, off: int, rnd_lst: List[int]) -> int:
+    #  #    81 [    h          i1  b          i2 raw_n_block   i_of_blc1   i_of_blc2...
+    # 23 81 00 [01 09 13 23 00 00 24 13 23 00 00 25 00 00 00 91 F1 E1 F4 A2 C5 F6 FE...
+    # raw_n_block: raw_number_of_blocks, number_of_blocks = (raw_n_block - 9) / 4
+    h, i1, b, i2, raw_n_block = _S_BLOCK15.unpack_from(buf, off)
+    off += 15
+    number_of_blocks = (raw_n_block - 9) >> 2
+    # the trailing id table just repeats the ids of the $ blocks, only cross-check it when debugging
+    if __debug__ and umd_io_logger.isEnabledFor(logging.DEBUG):
+        assert rnd_lst == _unpack_int32_array(buf, off, number_of_blocks).tolist()
+    return off + 4 * number_of_blocks
 
 
 class UMDFile:
     @staticmethod
-    def read_metadata(stream: IO, offset: int = None) -> Tuple[Dict, int]:
-        # offset == None : no offset
+    def read_metadata(buf: Buffer, offset: int = 0) -> Tuple[Dict, int]:
         # offset >= 0    : offset
         # offset <  0    : auto detect
-        if offset is not None:
-            if offset >= 0:
-                stream.seek(offset)
-            else:
-                stream.seek(0)
+        off = max(offset, 0)
 
         metadata = dict()
         # [file header]  #    01                 #    02
         # [89 9B 9A DE] 23 01 00 00 08 01 B1 0C 23 02 00 00 27 BB...
-        if stream.read(4) != b"\x89\x9b\x9a\xde":
+        if buf[off:off + 4] != b"\x89\x9b\x9a\xde":
             raise ValueError("Wrong File Header.")
+        off += 4
 
         while True:
             #             [ # bl_tp]                [ # bl_tp]
             # 89 9B 9A DE [23 01 00] 00 08 01 B1 0C [23 02 00] 00 27 BB...
             # bt: block_type_byte
-            splitter, block_type_byte = struct.unpack("<cH", stream.read(3))
+            splitter, block_type_byte = _S_SPLIT_TYPE.unpack_from(buf, off)
+            off += 3
             assert splitter == b'#'
             block_type = _BLOCK_TYPE_DICT.get(block_type_byte)
-            umd_io_logger.debug(f"block type: {block_type}")
-            if block_type_byte == 0x01:
-                #              #    01 [   h1 cb    h2]  #    02
-                # 89 9B 9A DE 23 01 00 [00 08 01 B1 0C] 23 02 00 00 27 BB...
-                # cb: category_byte
-                h1, category_byte, h2 = struct.unpack("<hbh", stream.read(5))
-                # only support novel!
-                metadata["category"] = {0x01: "Novel", "0x02": "Comic"}[category_byte]
-                umd_io_logger.debug(f"hi, h2: {h1}, {h2}")
-            elif block_type_byte in range(0x02, 0x0a):
-                #              # 00 01                 #    02 [b1 le chapters...
-                # 89 9B 9A DE 23 01 00 00 08 01 B1 0C 23 02 00 [00 27 BB 90 A7...
-                # le: raw_length, length = raw_length - 5
-                b1, raw_length = struct.unpack("<bb", stream.read(2))
-                content = stream.read(raw_length - 5).decode("utf-16-le")
-                metadata[block_type] = content
-                umd_io_logger.debug(f"b1: {b1}")
-            elif block_type_byte == 0x0b:
-                #  #    0b [   h1 full_length]  # 83
-                # 23 0b 00 [00 09 52 08 03 00] 23 83...
-                h1, full_length = struct.unpack("<hi", stream.read(6))
-                metadata["full_length"] = full_length
-                umd_io_logger.debug(f"h1: {h1}")
-            elif block_type_byte == 0x83:
-                #  #    83 [   h1          r1 b1          r2       ch_no ch01_offset ch02_offset ...
-                # 23 83 00 [01 09 B0 39 00 00 24 B0 39 00 00 3D 00 00 00 00 00 00 00 36 03 ...
-                # ch_no: raw_number_of_chapters, number_of_chapters = (raw_ch_no - 9) / 4
-                h1, i1, b1, i2, raw_ch_no = struct.unpack("<hibii", stream.read(15))
-                assert i1 == i2
-                number_of_chapters = int((raw_ch_no - 9) / 4)
-                chapter_offsets = struct.unpack("<" + "i" * number_of_chapters, stream.read(4 * number_of_chapters))
-                metadata["chapter_offsets"] = tuple(map(lambda x: int(x / 2), chapter_offsets))
-                umd_io_logger.debug(f"h1, i1, b1, i2: {h1}, {i1}, {b1}, {i2}")
-            elif block_type_byte == 0x84:
-                #  #    84 [   h1          i1 b1          i2 [ raw_tt_len l1 title1 ...
-                # 23 84 00 [01 09 02 4C 00 00 24 02 4C 00 00 [B0 01 00 00 10 2C 7B 00 4E 77 53 20 00 BA 4E ...
-                # raw_tt_len: raw_length_of_titles, title_length = raw_tt_len - 9
-                h1, i1, b1, i2, title_len = struct.unpack("<hibii", stream.read(15))
-                assert i1 == i2
-                end = stream.tell() + title_len - 9
-                content = []
-                while stream.tell() < end:
-                    ch_title_len = struct.unpack("<b", stream.read(1))[0]
-                    # title_bytes |> decode |> append to chapters list
-                    content.append(stream.read(ch_title_len).decode("utf-16-le"))
-                metadata["chapter_titles"] = content
-                umd_io_logger.debug(f"h1, i1, b1, i2: {h1}, {i1}, {b1}, {i2}")
-                break  # break the while loop !important
-            umd_io_logger.debug(f"{block_type}: {metadata.get(block_type)}")
-        metadata["body_offset"] = stream.tell()
-        umd_io_logger.info(f"{metadata['title']}: Read metadata success.")
+            umd_io_logger.debug("block type: %s", block_type)
+            handler = _METADATA_HANDLERS.get(block_type_byte)
+            if handler is None:
+                continue
+            off = handler(buf, off, block_type, metadata)
+            if block_type_byte == 0x84:
+                break  # chapter titles are the last metadata block, break the while loop !important
+            if umd_io_logger.isEnabledFor(logging.DEBUG):
+                umd_io_logger.debug("%s: %s", block_type, metadata.get(block_type))
+        metadata["body_offset"] = off
+        umd_io_logger.info("%s: Read metadata success.", metadata['title'])
         # only support novel!
         if metadata["category"] != "Novel":
             umd_io_logger.warning("Only support Novel!")
-        return metadata, stream.tell()
+        return metadata, off
 
     @staticmethod
-    def read_content(stream: IO, offset: int = None) -> Tuple[str, int]:
-        # offset == None : no offset
+    def read_content(buf: Buffer, offset: int = -1, full_length: int = None) -> Tuple[bytearray, int]:
         # offset >= 0    : offset
         # offset <  0    : auto detect
-        if offset is not None:
-            if offset >= 0:
-                stream.seek(offset)
-            else:
-                _, offset = UMDFile.read_metadata(stream, offset=-1)
-                stream.seek(offset)
+        # full_length    : uncompressed body size from the #0b block, used to preallocate the output
+        if offset >= 0:
+            off = offset
+        else:
+            metadata, off = UMDFile.read_metadata(buf)
+            full_length = metadata.get("full_length")
 
-        content_list = []
-        rnd_lst = []
-        splitter = stream.read(1)
-        while True:
-            if splitter == b'#':
-                end_type = struct.unpack("<h", stream.read(2))[0]
-                umd_io_logger.debug(f"end_type: {end_type}")
-                if end_type == 0x81:
-                    break
-                elif end_type == 0xf1:
-                    h, *c = struct.unpack("<h" + 16 * "c", stream.read(18))
-                    umd_io_logger.debug(f"h, s: {h}, {c}")
-                elif end_type == 0x0a:
-                    h, i = struct.unpack("<hi", stream.read(6))
-                    umd_io_logger.debug(f"h, i: {i}")
-                splitter = stream.read(1)
-                continue
-            elif splitter == b'$':
-                #  $           i raw_blc_len block...
-                # 24 91 F1 E1 F4 6D 45 00 00 78 9C 8D BD ...
-                # raw_blc_len: raw_block_length, block_length = raw_block_length - 9
-                i, raw_block_length = struct.unpack("<ii", stream.read(8))
-                umd_io_logger.debug(f"i: {i}")
-                rnd_lst.append(i)
-                block = stream.read(raw_block_length - 9)
-                # block |> decompress |> append to content_list
-                content_list.append(zlib.decompress(block))
-                splitter = stream.read(1)
-        #  #    81 [    h          i1  b          i2 raw_n_block   i_of_blc1   i_of_blc2...
-        # 23 81 00 [01 09 13 23 00 00 24 13 23 00 00 25 00 00 00 91 F1 E1 F4 A2 C5 F6 FE...
-        # raw_n_block: raw_number_of_blocks, number_of_blocks = (raw_n_block - 9) / 4
-        h, i1, b, i2, raw_n_block = struct.unpack("<hibii", stream.read(15))
-        number_of_blocks = int((raw_n_block - 9) / 4)
-        rnd_lst2 = struct.unpack("<" + "i" * number_of_blocks, stream.read(4 * number_of_blocks))
-        assert tuple(rnd_lst) == rnd_lst2
-        content = b"".join(content_list).decode("utf-16-le")
-        umd_io_logger.info(f"Read chapters success.")
-        return content, stream.tell()
+        raw_blocks, rnd_lst, off = _scan_body(buf, off)
+        off = _parse_end_of_body(buf, off, rnd_lst)
+        # every block is a complete zlib stream of its own, so they can't share one decompressobj
+        # keep the body as raw utf-16-le, chapters are decoded one by one later
+        # full_length is only a hint: it is a signed field and a corrupt one must not make us allocate gigabytes
+        if full_length is not None and 0 <= full_length <= _MAX_INFLATE_RATIO * sum(map(len, raw_blocks)):
+            content_bytes = bytearray(full_length)
+        else:
+            content_bytes = bytearray()
+        pos = 0
+        for block in raw_blocks:
+            chunk = zlib.decompress(block)
+            # grows the buffer by itself if the hint was missing or too small
+            content_bytes[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        del content_bytes[pos:]
+        umd_io_logger.info("Read chapters success.")
+        return content_bytes, off
 
     @staticmethod
-    def read_cover(stream: IO, offset: int = None) -> Tuple[bytes, int]:
-        # offset == None : no offset
+    def skip_content(buf: Buffer, offset: int = -1) -> int:
+        # same walk as read_content, but nothing is decompressed, returns the offset after the body
         # offset >= 0    : offset
         # offset <  0    : auto detect
-        if offset is not None:
-            if offset >= 0:
-                stream.seek(offset)
-            else:
-                _, offset = UMDFile.read_content(stream, offset=-1)
-                stream.seek(offset)
+        if offset >= 0:
+            off = offset
+        else:
+            _, off = UMDFile.read_metadata(buf)
+
+        _, rnd_lst, off = _scan_body(buf, off)
+        return _parse_end_of_body(buf, off, rnd_lst)
+
+    @staticmethod
+    def read_cover(buf: Buffer, offset: int = -1) -> Tuple[bytes, int]:
+        # offset >= 0    : offset
+        # offset <  0    : auto detect
+        if offset >= 0:
+            off = offset
+        else:
+            off = UMDFile.skip_content(buf)
 
-        splitter = stream.read(1)
-        if not splitter:
+        if off >= len(buf):
             cover = None
-            umd_io_logger.info(f"No cover.")
+            umd_io_logger.info("No cover.")
         else:
-            next_type = struct.unpack("<h", stream.read(2))[0]
+            next_type = _S_END_A.unpack_from(buf, off + 1)[0]
+            off += 3
             if next_type == 0x82:
-                b1, b2, b3, i1, b4, i2, raw_cover_length = struct.unpack("<bbbibii", stream.read(16))
-                cover = stream.read(raw_cover_length - 9)
-                umd_io_logger.info(f"Read cover success.")
+                b1, b2, b3, i1, b4, i2, raw_cover_length = _S_COVER.unpack_from(buf, off)
+                off += 16
+                cover = bytes(buf[off:off + raw_cover_length - 9])
+                off += raw_cover_length - 9
+                umd_io_logger.info("Read cover success.")
             else:
                 cover = None
-                umd_io_logger.info(f"No cover.")
-        return cover, stream.tell()
+                umd_io_logger.info("No cover.")
+        return cover, off
 
     def __init__(self,
                  title: str = None,
@@ -220,21 +352,43 @@ class UMDFile:
         self.metadata = metadata
 
     @staticmethod
-    def from_stream(stream: IO) -> "UMDFile":
-        metadata, offset1 = UMDFile.read_metadata(stream)
-        content, offset2 = UMDFile.read_content(stream, offset1)
-        cover, _ = UMDFile.read_cover(stream, offset2)
+    def from_bytes(buf: Buffer, read_chapters: bool = True) -> "UMDFile":
+        # read_chapters == False : metadata and cover only, the body is skipped and chapters is None
+        buf = memoryview(buf)
+        metadata, offset1 = UMDFile.read_metadata(buf)
+        if not read_chapters:
+            cover, _ = UMDFile.read_cover(buf, UMDFile.skip_content(buf, offset1))
+            return UMDFile(cover=cover, **metadata)
+        content_bytes, offset2 = UMDFile.read_content(buf, offset1, metadata.get("full_length"))
+        cover, _ = UMDFile.read_cover(buf, offset2)
         ch_list = []
+        # chapter offsets count utf-16 code units, i.e. 2 bytes each
+        offsets = metadata["chapter_offsets"]
+        body = memoryview(content_bytes)
         for i, ch_title in enumerate(metadata["chapter_titles"]):
-            if i + 1 == len(metadata["chapter_offsets"]):
-                ch_content = content[metadata["chapter_offsets"][i]:]
-            else:
-                ch_content = content[metadata["chapter_offsets"][i]:
-                                     metadata["chapter_offsets"][i + 1]]
-            ch_list.append(Chapter(ch_title, ch_content))
-        return UMDFile(chapters=ch_list, **metadata)
+            lo = offsets[i] * 2
+            hi = offsets[i + 1] * 2 if i + 1 < len(offsets) else len(body)
+            ch_list.append(Chapter(ch_title, body[lo:hi]))
+        return UMDFile(cover=cover, chapters=ch_list, **metadata)
+
+    @staticmethod
+    def from_stream(stream: IO, read_chapters: bool = True) -> "UMDFile":
+        return UMDFile.from_bytes(stream.read(), read_chapters)
 
     @staticmethod
     def from_file(fn: Path) -> "UMDFile":
         with open(fn, "rb") as file:
-            return UMDFile.from_stream(file)
+            try:
+                mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # empty file or no mmap support, read it the ordinary way
+                return UMDFile.from_stream(file)
+        try:
+            # nothing in the book points into the mapping: chapters view the inflated body, cover is a copy
+            return UMDFile.from_bytes(mm)
+        except Exception as e:
+            # the failed parse's frames still hold views into the mapping, drop them so it can be closed
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            mm.close()